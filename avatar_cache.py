@@ -0,0 +1,209 @@
+"""
+Local cache for OAuth profile pictures.
+
+Profile pictures returned by Facebook and Google are fetched once at
+login, shrunk to the size the page header actually displays, and
+written to local disk under a name derived from the image contents.
+Pages then reference the local copy instead of the provider's URL, so
+rendering never waits on a third-party image host. A returning user is
+served their previously cached picture straight away while a fresh copy
+is fetched in the background.
+"""
+
+
+import hashlib
+import os
+import threading
+import time
+from io import BytesIO
+
+import requests
+
+try:
+    from PIL import Image
+except ImportError:
+    # Without Pillow pictures are cached at their original size.
+    Image = None
+
+
+# Set AVATAR_CACHE_DIR to a directory writable by the web server user
+CACHE_DIR = os.environ.get('AVATAR_CACHE_DIR',
+                           os.path.join(os.path.dirname(
+                               os.path.abspath(__file__)), 'avatar_cache'))
+# Pointer files mapping a user's email to their current cached picture
+INDEX_DIR = os.path.join(CACHE_DIR, 'index')
+# Header picture is displayed at 50px wide, double that for HiDPI screens
+AVATAR_SIZE = (100, 100)
+FETCH_TIMEOUT = 5
+# Pictures no index points to are kept this long after they were last
+# handed to a login session, matching Flask's default session lifetime
+RETENTION = 31 * 24 * 60 * 60
+# File extensions for the picture types stored without resizing
+EXTENSIONS = {
+    'image/jpeg': 'jpg',
+    'image/png':  'png',
+    'image/gif':  'gif',
+    'image/webp': 'webp',
+}
+
+
+def _index_path(email):
+    """Return the path of the pointer file for the given user email."""
+    key = hashlib.sha1(email.encode('utf-8')).hexdigest()
+    return os.path.join(INDEX_DIR, key)
+
+
+def _write_atomic(path, data):
+    """Write data to path so readers never see a partial file."""
+    tmp_path = '%s.%d.%s.tmp' % (path, os.getpid(),
+                                 threading.current_thread().ident)
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+
+def _resize(data, content_type):
+    """Return the image bytes shrunk to AVATAR_SIZE, and their file
+    extension. Without Pillow the bytes are returned unchanged, with the
+    extension matching content_type. Return None if the data isn't an
+    image that can be stored.
+    """
+    if Image is None:
+        content_type = (content_type or '').split(';')[0].strip().lower()
+        if content_type not in EXTENSIONS:
+            return None
+        return data, EXTENSIONS[content_type]
+    try:
+        image = Image.open(BytesIO(data))
+        image.thumbnail(AVATAR_SIZE, Image.LANCZOS)
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        output = BytesIO()
+        image.save(output, 'JPEG', quality=85)
+        return output.getvalue(), 'jpg'
+    except Exception:
+        # Pillow raises many error types for corrupt or hostile images
+        return None
+
+
+def ensure_cache_dir():
+    """Create the cache directories if they don't exist yet."""
+    if not os.path.isdir(INDEX_DIR):
+        try:
+            os.makedirs(INDEX_DIR)
+        except OSError:
+            # Another worker created it first
+            if not os.path.isdir(INDEX_DIR):
+                raise
+
+
+def get_cached_avatar(email):
+    """Return the filename of the user's cached picture, or None if the
+    user has no picture on disk.
+    """
+    try:
+        with open(_index_path(email), 'r') as f:
+            filename = f.read().strip()
+    except IOError:
+        return None
+    if filename and os.path.exists(os.path.join(CACHE_DIR, filename)):
+        return filename
+    return None
+
+
+def fetch_avatar(email, url):
+    """Download, resize, and store the picture at url for the given user.
+
+    Return the filename of the stored picture, or None if the picture
+    couldn't be downloaded or stored.
+    """
+    try:
+        response = requests.get(url, timeout=FETCH_TIMEOUT)
+        response.raise_for_status()
+    except requests.RequestException:
+        return None
+    resized = _resize(response.content, response.headers.get('Content-Type'))
+    if resized is None:
+        return None
+    data, extension = resized
+    filename = '%s.%s' % (hashlib.sha1(data).hexdigest(), extension)
+    try:
+        _store(email, filename, data)
+    except EnvironmentError:
+        return None
+    return filename
+
+
+def _store(email, filename, data):
+    """Write the picture to disk and point the user's index at it.
+
+    The user's previous picture is left in place, since login sessions
+    may still link to it. It is removed later by prune().
+    """
+    ensure_cache_dir()
+    previous = get_cached_avatar(email)
+    path = os.path.join(CACHE_DIR, filename)
+    if not os.path.exists(path):
+        _write_atomic(path, data)
+    _write_atomic(_index_path(email), filename.encode('utf-8'))
+    if previous is not None and previous != filename:
+        prune()
+
+
+def _touch(filename):
+    """Mark a cached picture as just handed to a login session."""
+    try:
+        os.utime(os.path.join(CACHE_DIR, filename), None)
+    except OSError:
+        # Removed since we looked it up, prune() will skip it
+        pass
+
+
+def prune():
+    """Delete cached pictures that no user's index points to and that
+    no login session has been given for RETENTION seconds.
+    """
+    in_use = set()
+    for name in os.listdir(INDEX_DIR):
+        if name.endswith('.tmp'):
+            continue
+        try:
+            with open(os.path.join(INDEX_DIR, name), 'r') as f:
+                in_use.add(f.read().strip())
+        except IOError:
+            # Pointer was replaced while we were reading it
+            continue
+    cutoff = time.time() - RETENTION
+    for name in os.listdir(CACHE_DIR):
+        path = os.path.join(CACHE_DIR, name)
+        if name in in_use or not os.path.isfile(path):
+            continue
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            # Already removed by another worker
+            pass
+
+
+def refresh_avatar(email, url):
+    """Fetch a fresh copy of the user's picture in a background thread."""
+    thread = threading.Thread(target=fetch_avatar, args=(email, url))
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def cache_avatar(email, url):
+    """Return the filename of a locally cached copy of the picture at url.
+
+    Users who already have a cached picture get it back immediately, and
+    it is refreshed in the background. Otherwise the picture is fetched
+    now. Return None if no local copy is available.
+    """
+    filename = get_cached_avatar(email)
+    if filename is not None:
+        _touch(filename)
+        refresh_avatar(email, url)
+        return filename
+    return fetch_avatar(email, url)
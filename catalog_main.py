@@ -15,32 +15,37 @@ same, or from creating new content themselves.
 
 import httplib2
 import json
+import os
 import requests
 import random
 import string
+import time
 from functools import wraps
 
 from sqlalchemy import create_engine, asc
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import sessionmaker, scoped_session, configure_mappers
 from flask import Flask, render_template, request, redirect, jsonify, url_for
-from flask import make_response, flash, g
+from flask import make_response, flash, g, send_from_directory
 from flask import session as login_session
 from oauth2client.client import flow_from_clientsecrets
 from oauth2client.client import FlowExchangeError
 
 from database_setup import Base, User, Category, Item
+import avatar_cache
 
 
 app = Flask(__name__)
 
 # Path for Ubuntu Web Server
-# CLIENT_ID = (json.loads(open('/var/www/FlaskApps/Item-Catalog/client_secrets.json', 'r').read())
-             # ['web']['client_id'])
+# CLIENT_SECRETS = '/var/www/FlaskApps/Item-Catalog/client_secrets.json'
 
-CLIENT_ID = (json.loads(open('client_secrets.json', 'r').read())
-             ['web']['client_id'])
+# Path for Vagrant Virtual Machine
+CLIENT_SECRETS = 'client_secrets.json'
 
 APPLICATION_NAME = "Catalog Web App"
+# Cached avatars are content-addressed, so they never change once served
+AVATAR_CACHE_TIMEOUT = 365 * 24 * 60 * 60
 # Connect to Database and create database session in Vagrant Virtual Machine
 engine = create_engine('postgresql+psycopg2://vagrant:vagrant'
                        + '@localhost/itemcatalog.db', echo=True)
@@ -53,7 +58,122 @@ engine = create_engine('postgresql+psycopg2://vagrant:vagrant'
 # engine = create_engine('sqlite:///itemcatalog.db')
 Base.metadata.bind = engine
 DBSession = sessionmaker(bind=engine)
-session = DBSession()
+# Each thread gets its own session, which is discarded after every request
+session = scoped_session(DBSession)
+
+
+def create_app():
+    """Load configuration and compile templates, without opening any
+    database connections, so the app is safe to import in a pre-fork
+    master process. Return the configured Flask app.
+    """
+    timings = []
+    _timed(timings, 'load config', load_config)
+    _timed(timings, 'configure mappers', configure_mappers)
+    _timed(timings, 'compile templates', compile_templates)
+    report_timings('create_app', timings)
+    return app
+
+
+def load_config():
+    """Read the Google client ID into the app config."""
+    app.config['CLIENT_ID'] = (json.loads(open(CLIENT_SECRETS, 'r').read())
+                               ['web']['client_id'])
+
+
+def get_client_id():
+    """Return the Google client ID, loading it if create_app() hasn't
+    been run.
+    """
+    if 'CLIENT_ID' not in app.config:
+        load_config()
+    return app.config['CLIENT_ID']
+
+
+def compile_templates():
+    """Compile every template up front so the first requests don't pay
+    for it.
+    """
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+
+def post_fork():
+    """Drop any database connections inherited from the parent process,
+    then warm up the worker. Call from the server's post-fork hook.
+    """
+    reset_connections()
+    warmup()
+
+
+def reset_connections():
+    """Discard the session and pooled connections inherited across a
+    fork, leaving the parent's sockets open for the parent.
+    """
+    session.remove()
+    try:
+        engine.dispose(close=False)
+    except TypeError:
+        # Before SQLAlchemy 1.4.33 dispose() closes the parent's sockets,
+        # so abandon the inherited pool for a new empty one instead
+        engine.pool = engine.pool.recreate()
+
+
+def warmup():
+    """Prime the connection pool before the worker accepts traffic."""
+    timings = []
+    _timed(timings, 'prime connection pool', prime_connection_pool)
+    _timed(timings, 'prepare avatar cache', prepare_avatar_cache)
+    report_timings('warmup', timings)
+
+
+def prime_connection_pool():
+    """Open as many connections as the pool keeps, then return them.
+    If the database can't be reached, connections are left to open on
+    demand once it can.
+    """
+    size = getattr(engine.pool, 'size', lambda: 1)()
+    connections = []
+    try:
+        for x in xrange(size):
+            connections.append(engine.connect())
+    except SQLAlchemyError as e:
+        print "warmup [pid %d]: connection pool not primed: %s" % (
+            os.getpid(), e)
+    finally:
+        for connection in connections:
+            connection.close()
+
+
+def prepare_avatar_cache():
+    """Create the avatar cache directories. Failure only disables the
+    cache, since logins fall back to the provider's picture URL.
+    """
+    try:
+        avatar_cache.ensure_cache_dir()
+    except EnvironmentError as e:
+        print "warmup [pid %d]: avatar cache unavailable: %s" % (os.getpid(),
+                                                                 e)
+
+
+def _timed(timings, name, f):
+    """Run f, recording how long it took under the given name."""
+    start = time.time()
+    f()
+    timings.append((name, time.time() - start))
+
+
+def report_timings(stage, timings):
+    """Print how long each phase of a startup stage took."""
+    for name, seconds in timings:
+        print "%s [pid %d]: %s took %.1f ms" % (stage, os.getpid(), name,
+                                                seconds * 1000)
+
+
+@app.teardown_appcontext
+def remove_session(exception=None):
+    """Return the request's database connection to the pool."""
+    session.remove()
 
 
 def check_login_status(f):
@@ -215,6 +335,13 @@ def show_login():
     return render_template('login.html', STATE=state)
 
 
+@app.route('/avatar/<filename>')
+def show_avatar(filename):
+    """Serve a locally cached user profile picture."""
+    return send_from_directory(avatar_cache.CACHE_DIR, filename,
+                               cache_timeout=AVATAR_CACHE_TIMEOUT)
+
+
 # JSON API's
 @app.route('/item/<int:item_id>/JSON')
 def item_json(item_id):
@@ -271,6 +398,17 @@ def get_user_id(email):
         return None
 
 
+def use_local_avatar(login_session):
+    """Point the login session's picture at a locally cached copy of
+    the user's profile picture. Keep the provider's URL if no local
+    copy could be made.
+    """
+    filename = avatar_cache.cache_avatar(login_session['email'],
+                                         login_session['picture'])
+    if filename is not None:
+        login_session['picture'] = url_for('show_avatar', filename=filename)
+
+
 @app.route('/fbconnect', methods=['POST'])
 def fbconnect():
     """Log users into their Facebook accounts and the Web app.
@@ -333,14 +471,15 @@ def fbconnect():
     if not user_id:
         user_id = create_user(login_session)
     login_session['user_id'] = user_id
+    use_local_avatar(login_session)
     output = ''
     output += '<h1>Welcome, '
     output += login_session['username']
     output += '!</h1>'
     output += '<img src="'
     output += login_session['picture']
-    output += ' " style = "width: 300px; height: 300px;border-radius: 150px;'
-    output += '-webkit-border-radius: 150px;-moz-border-radius: 150px;"> '
+    output += ' " style = "width: 100px; height: 100px;border-radius: 50px;'
+    output += '-webkit-border-radius: 50px;-moz-border-radius: 50px;"> '
     flash("Now logged in as %s" % login_session['username'])
     return output
 
@@ -408,7 +547,7 @@ def gconnect():
         response.headers['Content-Type'] = 'application/json'
         return response
     # Verify that the access token is valid for this app.
-    if result['issued_to'] != CLIENT_ID:
+    if result['issued_to'] != get_client_id():
         response = make_response(
             json.dumps("Token's client ID does not match app's."), 401)
         print "Token's client ID does not match app's."
@@ -438,14 +577,15 @@ def gconnect():
     if not user_id:
         user_id = create_user(login_session)
     login_session['user_id'] = user_id
+    use_local_avatar(login_session)
     output = ''
     output += '<h1>Welcome, '
     output += login_session['username']
     output += '!</h1>'
     output += '<img src="'
     output += login_session['picture']
-    output += ' " style = "width: 300px; height: 300px;border-radius: 150px;'
-    output += '-webkit-border-radius: 150px;-moz-border-radius: 150px;"> '
+    output += ' " style = "width: 100px; height: 100px;border-radius: 50px;'
+    output += '-webkit-border-radius: 50px;-moz-border-radius: 50px;"> '
     flash("you are now logged in as %s" % login_session['username'])
     return output
 
@@ -509,6 +649,11 @@ if __name__ == '__main__':
     # Use with Vagrant Virtual Machine
     app.secret_key = 'super_secret_key'
     app.debug = True
+    # The reloader re-runs this module in a child process which serves
+    # the requests, so only warm up there
+    if os.environ.get('WERKZEUG_RUN_MAIN'):
+        create_app()
+        warmup()
     app.run(host='0.0.0.0', port=8000)
     # Use with Ubuntu Server
     # app.run()
@@ -71,15 +71,18 @@ class Item(Base):
             'id':          self.id,
         }
 
-# Connect to Database and create database session in Vagrant Virtual Machine
-engine = create_engine('postgresql+psycopg2://vagrant:vagrant'
-                       + '@localhost/itemcatalog.db', echo=True)
 
-# Connect to Database and create database session in Ubuntu Web Server
-# engine = create_engine('postgresql+psycopg2://ubuntu:ubuntu'
-#                        + '@localhost/itemcatalog.db', echo=False)
+if __name__ == '__main__':
+    # Connect to Database and create database session in Vagrant
+    # Virtual Machine
+    engine = create_engine('postgresql+psycopg2://vagrant:vagrant'
+                           + '@localhost/itemcatalog.db', echo=True)
 
-# engine = create_engine('sqlite:///itemcatalog.db')
-Base.metadata.create_all(engine)
+    # Connect to Database and create database session in Ubuntu Web Server
+    # engine = create_engine('postgresql+psycopg2://ubuntu:ubuntu'
+    #                        + '@localhost/itemcatalog.db', echo=False)
 
-print "Database has been setup, and its tables defined"
+    # engine = create_engine('sqlite:///itemcatalog.db')
+    Base.metadata.create_all(engine)
+
+    print "Database has been setup, and its tables defined"
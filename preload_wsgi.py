@@ -0,0 +1,11 @@
+"""
+WSGI entry point for servers that import the app once in a master
+process and then fork workers, such as Gunicorn with --preload. Nothing
+here opens a database connection. Each worker must call
+catalog_main.post_fork() before accepting traffic.
+"""
+
+
+import catalog_main
+
+application = catalog_main.create_app()